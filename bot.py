@@ -1,10 +1,11 @@
 import os
 import re
+import json
 import asyncio
+import hashlib
 import discord
 from discord.ext import commands
 from discord import app_commands
-from collections import defaultdict
 from enum import Enum
 
 # ---------- INTENTS ----------
@@ -23,12 +24,71 @@ class AttachmentFilter(str, Enum):
 
 # URL detection regex
 URL_REGEX = re.compile(r"https?://\S+")
+_url_search = URL_REGEX.search
+
+# Discord message link — captures the message ID
+# (also matches ptb./canary. and the legacy discordapp.com domain)
+_MSG_LINK_RE = re.compile(r"^https?://(?:\w+\.)?discord(?:app)?\.com/channels/\d+/\d+/(\d+)/?$")
+
+# Cross reaction detection — built once instead of on every call
+_UNICODE_CROSSES = frozenset({"❌", "❎", "✖", "✕"})
+_CROSS_NAME_WORDS = ("cross", "x", "reject", "wrong", "fail")
+
+# Messages per history request (Discord's maximum)
+HISTORY_PAGE_SIZE = 100
+
+# Number of concurrent role assignment workers
+ASSIGN_WORKERS = 5
+
+# Minimum seconds between progress message edits
+PROGRESS_EDIT_INTERVAL = 2.0
+
+# Minimum seconds between role assignments, shared across all workers.
+# discord.py already waits out rate limits on its own, so this is 0 by
+# default — raise it to pace assignments (e.g. 0.3 for one every 0.3s)
+SLEEP_PER_ASSIGN = 0.0
+
+# Seconds to wait before retrying an assignment that is still rate limited (429)
+# after discord.py's own retries
+RATE_LIMIT_RETRY_DELAY = 5.0
+
+# Seconds to wait before retrying an assignment that hit a Discord 5xx error
+SERVER_ERROR_RETRY_DELAY = 1.0
+
+
+# Where the hash of the last synced command tree is kept between restarts
+TREE_SIG_PATH = os.path.expanduser("~/.role_scanner_tree.sig")
+
+
+# ---------- COMMAND TREE SIGNATURE ----------
+def command_tree_signature() -> str:
+    payload = {
+        "application_id": bot.application_id,
+        "commands": [cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands()],
+    }
+    data = json.dumps(payload, default=str, sort_keys=True).encode()
+    return hashlib.blake2b(data).hexdigest()
 
 
 # ---------- ON READY ----------
 @bot.event
 async def on_ready():
-    await bot.tree.sync()
+    # Global syncs are rate limited — only sync when the commands changed
+    sig = command_tree_signature()
+    try:
+        with open(TREE_SIG_PATH) as f:
+            synced_sig = f.read().strip()
+    except OSError:
+        synced_sig = None
+
+    if sig != synced_sig:
+        await bot.tree.sync()
+        try:
+            with open(TREE_SIG_PATH, "w") as f:
+                f.write(sig)
+        except OSError:
+            pass
+
     print(f"Logged in as {bot.user}")
 
 
@@ -44,120 +104,278 @@ def has_manage_roles():
     return app_commands.check(predicate)
 
 
-# ---------- CROSS REACTION DETECTOR ----------
-def is_cross_reaction(reaction: discord.Reaction) -> bool:
-    unicode_crosses = {"❌", "❎", "✖", "✕"}
-    if isinstance(reaction.emoji, str):
-        return reaction.emoji in unicode_crosses
-    if isinstance(reaction.emoji, discord.Emoji):
-        name = reaction.emoji.name.lower()
-        return any(word in name for word in ["cross", "x", "reject", "wrong", "fail"])
-    return False
+# ---------- ROLE HIERARCHY CHECK ----------
+def check_role_assignable(interaction: discord.Interaction, role: discord.Role) -> str | None:
+    # Role ordering (not raw .position) — roles can share a position, and
+    # discord.py breaks those ties by id the same way Discord does
+    if role >= interaction.guild.me.top_role:
+        return (
+            "❌ I can't assign that role — it's higher than or equal to my highest role. "
+            "Please move my bot role above the target role in Server Settings → Roles."
+        )
+    return None
 
 
-# ---------- ATTACHMENT FILTER CHECK ----------
-def passes_attachment_filter(message: discord.Message, filter: AttachmentFilter) -> bool:
-    if filter == AttachmentFilter.none:
-        return True  # No filter, everyone passes
+# ---------- PREFETCHING HISTORY ----------
+async def fetch_history_page(channel, after, before) -> list[discord.Message]:
+    return [
+        m async for m in channel.history(
+            limit=HISTORY_PAGE_SIZE, after=after, before=before, oldest_first=True
+        )
+    ]
 
-    if filter == AttachmentFilter.image:
-        for attachment in message.attachments:
-            if attachment.content_type and attachment.content_type.startswith("image/"):
-                return True
-        return False
 
-    if filter == AttachmentFilter.link:
-        return bool(URL_REGEX.search(message.content))
+async def prefetched_history(channel, after=None, before=None):
+    # Yields messages oldest first, fetching the next page while the
+    # current one is being processed
+    page = await fetch_history_page(channel, after, before)
+    while page:
+        next_page_task = None
+        if len(page) == HISTORY_PAGE_SIZE:
+            next_page_task = asyncio.create_task(fetch_history_page(channel, page[-1], before))
+            await asyncio.sleep(0)  # let the request go out before we start processing
 
-    return True
+        try:
+            for message in page:
+                yield message
+        except BaseException:
+            if next_page_task is not None:
+                next_page_task.cancel()
+            raise
+
+        if next_page_task is None:
+            return
+        page = await next_page_task
 
 
 # ---------- SHARED PROCESSING LOGIC ----------
 async def process_messages(interaction, messages, role, attachment_filter: AttachmentFilter):
-    # Role hierarchy check upfront
-    if role >= interaction.guild.me.top_role:
-        await interaction.followup.send(
-            "❌ I can't assign that role — it's higher than or equal to my highest role. "
-            "Please move my bot role above the target role in Server Settings → Roles.",
-            ephemeral=True
-        )
-        return
-
-    user_has_clean = defaultdict(bool)
-    user_message_count = defaultdict(int)
+    # Keyed by user id — int hashing is far cheaper than discord.User's
+    clean_user_ids = set()
     all_users = set()
     filter_failed_users = set()
-
-    async for message in messages:
-        if message.author.bot:
-            continue
-
-        all_users.add(message.author)
-        user_message_count[message.author] += 1
-
-        # Check cross reaction
-        has_cross = any(
-            is_cross_reaction(r) and r.count > 0
-            for r in message.reactions
-        )
-        if has_cross:
-            continue
-
-        # Check attachment filter
-        if not passes_attachment_filter(message, attachment_filter):
-            filter_failed_users.add(message.author)
-            continue
-
-        user_has_clean[message.author] = True
-
-    valid_users = {u for u, ok in user_has_clean.items() if ok}
-    excluded_users = all_users - valid_users
-    duplicate_users = {u for u, c in user_message_count.items() if c > 1}
+    # Users who both failed the filter on one message and qualified on another
+    filter_failed_valid_count = 0
+    duplicate_users = set()
 
     guild = interaction.guild
     assigned_users = []
     already_had_role = []
     failed_users = []
 
-    total = len(valid_users)
     processed = 0
+    rate_limited_count = 0
 
     progress_msg = await interaction.followup.send(
-        f"⏳ Assigning roles... `0/{total}` done.",
+        "⏳ Scanning and assigning roles... `0/0` done.",
         ephemeral=True
     )
 
-    for user in valid_users:
-        member = guild.get_member(user.id)
-        if not member:
+    # Scanner feeds qualifying users straight to the assign workers, so role
+    # assignment overlaps with the history fetch instead of waiting for it
+    queue = asyncio.Queue(maxsize=256)
+
+    # Bound once — guild._members is the id → Member cache behind get_member
+    get_member = guild._members.get
+
+    async def enqueue(user):
+        nonlocal processed
+        member = get_member(user.id)
+        if member is None:
+            # Never reaches the assign workers
             failed_users.append(f"{user} (left server?)")
             processed += 1
-            continue
-
-        if role in member.roles:
+            return
+        await queue.put((user, member))
+
+    async def produce():
+        nonlocal filter_failed_valid_count
+        # Bind hot-loop names locally — the classify step below runs once per message
+        unicode_crosses = _UNICODE_CROSSES
+        cross_words = _CROSS_NAME_WORDS
+        Emoji = discord.Emoji
+        url_search = _url_search
+        want_image = attachment_filter is AttachmentFilter.image
+        want_link = attachment_filter is AttachmentFilter.link
+
+        # With no attachment filter only cross reactions can disqualify,
+        # so the filter branch below is skipped entirely
+        filtering = want_image or want_link
+
+        async for message in messages:
+            author = message.author
+            if author.bot:
+                continue
+            author_id = author.id
+
+            if author_id in all_users:
+                duplicate_users.add(author_id)
+            else:
+                all_users.add(author_id)
+
+            # Check cross reaction
+            has_cross = False
+            for r in message.reactions:
+                if r.count <= 0:
+                    continue
+                emoji = r.emoji
+                if isinstance(emoji, str):
+                    if emoji in unicode_crosses:
+                        has_cross = True
+                        break
+                elif isinstance(emoji, Emoji):
+                    name = emoji.name.lower()
+                    for word in cross_words:
+                        if word in name:
+                            has_cross = True
+                            break
+                    if has_cross:
+                        break
+            if has_cross:
+                continue
+
+            # Check attachment filter
+            if filtering:
+                if want_image:
+                    passed = False
+                    for attachment in message.attachments:
+                        content_type = attachment.content_type
+                        if content_type and content_type.startswith("image/"):
+                            passed = True
+                            break
+                else:
+                    # Cheap substring reject before running the regex
+                    content = message.content
+                    passed = "http" in content and url_search(content) is not None
+
+                if not passed:
+                    if author_id not in filter_failed_users:
+                        filter_failed_users.add(author_id)
+                        if author_id in clean_user_ids:
+                            filter_failed_valid_count += 1
+                    continue
+
+            # Hand the user to the assign workers the first time they qualify
+            if author_id not in clean_user_ids:
+                clean_user_ids.add(author_id)
+                if author_id in filter_failed_users:
+                    filter_failed_valid_count += 1
+                await enqueue(author)
+
+    role_id = role.id
+    Forbidden = discord.Forbidden
+    HTTPException = discord.HTTPException
+
+    loop = asyncio.get_running_loop()
+    # Shared pacing for SLEEP_PER_ASSIGN so the delay holds across all workers
+    pace_lock = asyncio.Lock()
+    next_assign_at = loop.time()
+
+    async def pace():
+        nonlocal next_assign_at
+        async with pace_lock:
+            delay = next_assign_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_assign_at = loop.time() + SLEEP_PER_ASSIGN
+
+    async def assign(user, member):
+        nonlocal rate_limited_count
+        # member._roles is discord.py's internal SnowflakeList of role ids —
+        # .has() binary-searches it without building Role objects (stable in 2.x)
+        if member._roles.has(role_id):
             already_had_role.append(user)
-            processed += 1
-            continue
+            return
 
+        # Rate limits and server errors are usually transient — retry once.
+        # discord.py has already retried both up to 5 times before raising,
+        # so these retries come on top of the library's own
+        for attempt in range(2):
+            if SLEEP_PER_ASSIGN:
+                await pace()
+            try:
+                await member.add_roles(role, reason="Event submission scan")
+                assigned_users.append(user)
+            except Forbidden:
+                failed_users.append(f"{user} (permission denied)")
+            except HTTPException as e:
+                if e.status == 429:
+                    if attempt == 0:
+                        rate_limited_count += 1
+                        await asyncio.sleep(RATE_LIMIT_RETRY_DELAY)
+                        continue
+                    failed_users.append(f"{user} (rate limited)")
+                elif e.status >= 500 and attempt == 0:
+                    await asyncio.sleep(SERVER_ERROR_RETRY_DELAY)
+                    continue
+                else:
+                    failed_users.append(f"{user} (HTTP error: {e.status})")
+            break
+
+    last_edit = loop.time()
+    edit_task = None
+
+    async def update_progress():
         try:
-            await member.add_roles(role, reason="Event submission scan")
-            assigned_users.append(user)
-        except discord.Forbidden:
-            failed_users.append(f"{user} (permission denied)")
-        except discord.HTTPException as e:
-            failed_users.append(f"{user} (HTTP error: {e.status})")
-
-        processed += 1
-
-        if processed % 10 == 0:
+            await progress_msg.edit(
+                content=f"⏳ Scanning and assigning roles... "
+                        f"`{processed}/{len(clean_user_ids)}` done."
+            )
+        except Exception:
+            pass
+
+    async def consume():
+        nonlocal processed, last_edit, edit_task
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
             try:
-                await progress_msg.edit(
-                    content=f"⏳ Assigning roles... `{processed}/{total}` done."
-                )
-            except Exception:
-                pass
+                await assign(*item)
+            except Exception as e:
+                # e.g. a dropped connection — record it so the worker keeps
+                # draining the queue instead of dying and stalling the scanner
+                failed_users.append(f"{item[0]} ({type(e).__name__})")
+            processed += 1
 
-        await asyncio.sleep(0.3)
+            # Progress edits share the rate limit with add_roles — throttle them
+            # by time and skip while the previous edit is still in flight
+            now = loop.time()
+            if now - last_edit > PROGRESS_EDIT_INTERVAL and (edit_task is None or edit_task.done()):
+                last_edit = now
+                edit_task = asyncio.create_task(update_progress())
+
+    # A fixed pool of workers bounds concurrent add_roles calls —
+    # discord.py's rate limiter paces the requests themselves
+    workers = [asyncio.create_task(consume()) for _ in range(ASSIGN_WORKERS)]
+    scan_error = None
+    try:
+        await produce()
+    except Exception as e:
+        # Roles are already being granted — let the workers finish what was
+        # queued and still report who got the role, rather than bailing out
+        scan_error = e
+    except BaseException:
+        # Cancelled — stop the workers rather than waiting on the queue
+        for w in workers:
+            w.cancel()
+        if edit_task is not None:
+            edit_task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+    if edit_task is not None:
+        # Don't let a late progress edit overwrite the final report
+        await edit_task
+
+    # Users with no clean message who never failed the filter were crossed out
+    cross_excluded_count = (
+        len(all_users) - len(clean_user_ids)
+        - len(filter_failed_users) + filter_failed_valid_count
+    )
 
     # Filter label for report
     filter_label = {
@@ -166,28 +384,31 @@ async def process_messages(interaction, messages, role, attachment_filter: Attac
         AttachmentFilter.link:  "URL/Link only",
     }[attachment_filter]
 
-    failed_section = ""
-    if failed_users:
-        display_failed = failed_users[:20]
-        failed_section = (
-            f"\n⚠️ **Failed assignments ({len(failed_users)}):**\n"
-            + "\n".join(f"  • {u}" for u in display_failed)
-        )
-        if len(failed_users) > 20:
-            failed_section += f"\n  ... and {len(failed_users) - 20} more."
-
-    report = (
-        f"✅ **Scan Complete**\n\n"
-        f"🔍 **Attachment filter:** {filter_label}\n"
-        f"👥 **Total users scanned:** {len(all_users)}\n"
-        f"🏷️ **New roles assigned:** {len(assigned_users)}\n"
-        f"🟦 **Already had role:** {len(already_had_role)}\n"
-        f"❌ **Disqualified (cross reaction):** {len(excluded_users - filter_failed_users)}\n"
-        f"🖼️ **Disqualified (attachment filter):** {len(filter_failed_users)}\n"
-        f"🔁 **Duplicate submitters:** {len(duplicate_users)}\n"
-        f"💥 **Failed to assign:** {len(failed_users)}"
-        + failed_section
-    )
+    failed_n = len(failed_users)
+    report_lines = [
+        "⚠️ **Scan Aborted** — results below are partial" if scan_error else "✅ **Scan Complete**",
+        "",
+        f"🔍 **Attachment filter:** {filter_label}",
+        f"👥 **Total users scanned:** {len(all_users)}",
+        f"🏷️ **New roles assigned:** {len(assigned_users)}",
+        f"🟦 **Already had role:** {len(already_had_role)}",
+        f"❌ **Disqualified (cross reaction):** {cross_excluded_count}",
+        f"🖼️ **Disqualified (attachment filter):** {len(filter_failed_users)}",
+        f"🔁 **Duplicate submitters:** {len(duplicate_users)}",
+        f"🚦 **Rate-limited (retried):** {rate_limited_count}",
+        f"💥 **Failed to assign:** {failed_n}",
+    ]
+    if scan_error:
+        report_lines.append(f"⛔ **Scan aborted:** `{scan_error}`")
+    if failed_n:
+        report_lines.append(f"⚠️ **Failed assignments ({failed_n}):**")
+        report_lines.extend(f"  • {u}" for u in failed_users[:20])
+        extra = failed_n - 20
+        if extra > 0:
+            report_lines.append(f"  ... and {extra} more.")
+
+    # Single join into one buffer instead of chained concatenation
+    report = "\n".join(report_lines)
 
     try:
         await progress_msg.edit(content=report)
@@ -197,10 +418,29 @@ async def process_messages(interaction, messages, role, attachment_filter: Attac
 
 # ---------- PARSE MESSAGE ID FROM LINK ----------
 def parse_message_id(link: str) -> int | None:
-    try:
-        return int(link.strip().split("/")[-1])
-    except Exception:
-        return None
+    m = _MSG_LINK_RE.match(link.strip())
+    return int(m.group(1)) if m else None
+
+
+# ---------- RESOLVE START/END RANGE ----------
+def resolve_range(start_message: str | None, end_message: str | None) -> tuple[int | None, int | None, str | None]:
+    start_id = None
+    end_id = None
+
+    if start_message:
+        start_id = parse_message_id(start_message)
+        if start_id is None:
+            return None, None, "❌ Invalid start message link. Right-click a message → Copy Message Link."
+
+    if end_message:
+        end_id = parse_message_id(end_message)
+        if end_id is None:
+            return None, None, "❌ Invalid end message link. Right-click a message → Copy Message Link."
+
+    if start_id and end_id and start_id >= end_id:
+        return None, None, "❌ Start message must be older than the end message."
+
+    return start_id, end_id, None
 
 
 # ---------- /giverolechannel ----------
@@ -226,41 +466,21 @@ async def giverolechannel(
 ):
     await interaction.response.defer(ephemeral=True)
 
-    start_id = None
-    end_id = None
-
-    if start_message:
-        start_id = parse_message_id(start_message)
-        if start_id is None:
-            await interaction.followup.send(
-                "❌ Invalid start message link. Right-click a message → Copy Message Link.",
-                ephemeral=True
-            )
-            return
-
-    if end_message:
-        end_id = parse_message_id(end_message)
-        if end_id is None:
-            await interaction.followup.send(
-                "❌ Invalid end message link. Right-click a message → Copy Message Link.",
-                ephemeral=True
-            )
-            return
+    # Bail out before parsing links or touching history if the role is out of reach
+    error = check_role_assignable(interaction, role)
+    if error:
+        await interaction.followup.send(error, ephemeral=True)
+        return
 
-    if start_id and end_id and start_id >= end_id:
-        await interaction.followup.send(
-            "❌ Start message must be older than the end message.",
-            ephemeral=True
-        )
+    start_id, end_id, error = resolve_range(start_message, end_message)
+    if error:
+        await interaction.followup.send(error, ephemeral=True)
         return
 
-    history_kwargs = {"limit": None, "oldest_first": True}
-    if start_id:
-        history_kwargs["after"] = discord.Object(id=start_id - 1)
-    if end_id:
-        history_kwargs["before"] = discord.Object(id=end_id + 1)
+    after = discord.Object(id=start_id - 1) if start_id else None
+    before = discord.Object(id=end_id + 1) if end_id else None
 
-    messages = channel.history(**history_kwargs)
+    messages = prefetched_history(channel, after, before)
     await process_messages(interaction, messages, role, attachment_filter)
 
 
@@ -285,6 +505,12 @@ async def giverolethread(
 ):
     await interaction.response.defer(ephemeral=True)
 
+    # Bail out before parsing links or touching history if the role is out of reach
+    error = check_role_assignable(interaction, role)
+    if error:
+        await interaction.followup.send(error, ephemeral=True)
+        return
+
     if not isinstance(interaction.channel, discord.Thread):
         await interaction.followup.send(
             "❌ This command must be used inside a thread.",
@@ -303,35 +529,15 @@ async def giverolethread(
             )
             return
 
-    start_id = None
-    end_id = None
-
-    if start_message:
-        start_id = parse_message_id(start_message)
-        if start_id is None:
-            await interaction.followup.send("❌ Invalid start message link.", ephemeral=True)
-            return
-
-    if end_message:
-        end_id = parse_message_id(end_message)
-        if end_id is None:
-            await interaction.followup.send("❌ Invalid end message link.", ephemeral=True)
-            return
-
-    if start_id and end_id and start_id >= end_id:
-        await interaction.followup.send(
-            "❌ Start message must be older than the end message.",
-            ephemeral=True
-        )
+    start_id, end_id, error = resolve_range(start_message, end_message)
+    if error:
+        await interaction.followup.send(error, ephemeral=True)
         return
 
-    history_kwargs = {"limit": None, "oldest_first": True}
-    if start_id:
-        history_kwargs["after"] = discord.Object(id=start_id - 1)
-    if end_id:
-        history_kwargs["before"] = discord.Object(id=end_id + 1)
+    after = discord.Object(id=start_id - 1) if start_id else None
+    before = discord.Object(id=end_id + 1) if end_id else None
 
-    messages = interaction.channel.history(**history_kwargs)
+    messages = prefetched_history(interaction.channel, after, before)
     await process_messages(interaction, messages, role, attachment_filter)
 
 